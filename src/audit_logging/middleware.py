@@ -1,23 +1,36 @@
-import json
+import atexit
+import io
+import itertools
+import os
 import boto3
+import orjson
+import random
+import sys
+import threading
 import time
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
 from uuid import uuid4
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.paginator import Page
 from django.db.models import Model
-from django.db.models.query import QuerySet
-from django.utils import timezone
+from django.db.models.query import ModelIterable, QuerySet
 
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.serializers import Serializer
 
+from audit_logging.s3 import DirectS3Uploader
 from audit_logging.utils import AuditableResponse
 
-from typing import TypedDict
+from typing import Any, Callable, Collection, NotRequired, TypedDict
 
 
 """
@@ -27,32 +40,150 @@ This happens automatically for any view declared as part of a builtin ViewSet ob
 than a response. 
 If the view is not declared as part of a built in ViewSet or returns a Response object and the function requires audit logs
 then the return type needs to be switched to AuditableResponse
+Audited QuerySets that were already evaluated (e.g. by accessing serializer.data, as the built in ViewSets do) are read
+from their result cache. Unevaluated QuerySets cost one extra query selecting only the primary keys, so views should
+pass the QuerySet they rendered rather than a fresh copy of it.
 """
 
 
+# Both are only used as annotations, records are built as dict literals since calling a TypedDict
+# goes through the much slower dict(**kwargs) path
 class AuditDataElement(TypedDict):
     model: str
     primary_key: str
 
 
 class AuditPayload(TypedDict):
-    username: str
+    # None only in the records logged on shutdown for sampled out requests no audited request accounted for
+    username: str | None
     request_path: str
     access_time: str
-    ip: str
-    elapsed_time_seconds: str
+    ip: str | None
+    elapsed_time_seconds: float | None
     audit_data: list[AuditDataElement]
     service_name: str | None
+    # only present for sampled paths, each logged request stands for itself and the sampled_out_count
+    # requests to the same path with auditable responses that were dropped since the previous one
+    sample_rate: NotRequired[float]
+    sampled_out_count: NotRequired[int]
+
+
+def _audit_queryset(queryset: QuerySet) -> list[AuditDataElement]:
+    model_name = queryset.model.__name__
+
+    # the serializer already fetched the rows, read the keys from memory instead of querying again
+    if queryset._result_cache is not None and queryset._iterable_class is ModelIterable:
+        return [
+            {"model": model_name, "primary_key": instance.pk}
+            for instance in queryset._result_cache
+        ]
+
+    # otherwise only the primary key column is selected, no model instances are built
+    return [
+        {"model": model_name, "primary_key": pk}
+        for pk in queryset.values_list("pk", flat=True)
+    ]
+
+
+def _audit_model_instances(instances: Collection[Model]) -> list[AuditDataElement]:
+    if len(instances) == 0:
+        return []
+
+    # lists are almost always of a single model, so the name is resolved once from the first element
+    # and only looked up again for rows of a different type
+    model_type = type(next(iter(instances)))
+    model_name = model_type.__name__
+    return [
+        {
+            "model": (
+                model_name if type(instance) is model_type else type(instance).__name__
+            ),
+            "primary_key": instance.pk,
+        }
+        for instance in instances
+    ]
+
+
+def _audit_page(page: Page) -> list[AuditDataElement]:
+    if isinstance(page.object_list, QuerySet):
+        return _audit_queryset(page.object_list)
+    return _audit_model_instances(page.object_list)
+
+
+# Maps the type of a serializer instance to a function returning its audit data elements.
+# Lookups are by exact type, subclasses are resolved through their MRO once and then cached here.
+_EGRESSED_DATA_EXTRACTORS: dict[type, Callable[[Any], list[AuditDataElement]]] = {
+    QuerySet: _audit_queryset,
+    list: _audit_model_instances,
+    Page: _audit_page,
+    set: _audit_model_instances,
+    Model: lambda instance: _audit_model_instances([instance]),
+}
+
+
+def _get_egressed_data_extractor(
+    instance_type: type,
+) -> Callable[[Any], list[AuditDataElement]] | None:
+    if (extractor := _EGRESSED_DATA_EXTRACTORS.get(instance_type)) is not None:
+        return extractor
+
+    for base in instance_type.__mro__[1:]:
+        if (extractor := _EGRESSED_DATA_EXTRACTORS.get(base)) is not None:
+            _EGRESSED_DATA_EXTRACTORS[instance_type] = extractor
+            return extractor
+
+    return None
+
+
+# HTTP headers for the boto3 upload arguments the middleware sets
+_S3_EXTRA_ARG_HEADERS = {"ContentEncoding": "Content-Encoding"}
 
 
 class EgressAuditLogMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    # checked in order, the first header present identifies the caller
+    _IP_HEADERS = ("HTTP_X_FORWARDED_FOR", "HTTP_X_REAL_IP", "REMOTE_ADDR")
+
     def __init__(self, get_response) -> None:
         self.get_response = get_response
-        self.client = boto3.client("s3")
+        self.client = None
+        # under ASGI Django hands us a coroutine, run natively instead of being adapted to sync on every request
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
         self._configure_logging()
 
+        # logs are shipped from a background pool so the response is never held up by the log sink
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.logging_config.get("max_workers", 8),
+            thread_name_prefix="egress-audit-log",
+        )
+        atexit.register(self.shutdown)
+
     def _configure_logging(self) -> None:
         self.logging_config = settings.EGRESS_LOGGING_CONFIGURATION
+        self.service_name = self.logging_config.get("service_name")
+        # same result as timezone.now() without going through settings on every request
+        self._tz = dt_timezone.utc if settings.USE_TZ else None
+
+        # per path fraction of requests to audit, e.g. {"/hot/path": 0.01}, paths not listed are always audited
+        self._samplers: dict[str, float] = {
+            path: float(rate)
+            for path, rate in self.logging_config.get("sampling", {}).items()
+        }
+        self._sampled_out: Counter[str] = Counter()
+        self._sampled_out_lock = threading.Lock()
+
+        # at most this many records wait on the background pool, and as many again in the S3 buffer. Records past
+        # it are dropped and counted rather than letting a slow or failing sink grow memory without bound
+        self.max_buffered_records = self.logging_config.get(
+            "max_buffered_records", 10_000
+        )
+        self._queued_records = threading.BoundedSemaphore(self.max_buffered_records)
+        self._dropped_records = 0
+        self._dropped_records_lock = threading.Lock()
 
         match self.logging_config["log_type"]:
             case "s3":
@@ -64,50 +195,222 @@ class EgressAuditLogMiddleware:
                 self.s3_bucket = self.logging_config["s3_bucket"]
                 self.log_func = self.log_s3
 
+                # one long lived client shared by every worker, with enough pooled keep alive connections
+                # for the background workers and the concurrent parts of a multipart upload
+                self.client = boto3.client(
+                    "s3",
+                    config=Config(
+                        max_pool_connections=self.logging_config.get(
+                            "max_pool_connections", 50
+                        ),
+                        tcp_keepalive=True,
+                    ),
+                )
+
+                # payloads are buffered and uploaded as a single JSONL object per batch
+                self.batch_max_records = self.logging_config.get(
+                    "batch_max_records", 500
+                )
+                self.flush_interval_seconds = self.logging_config.get(
+                    "flush_interval_seconds", 5
+                )
+                # large batches go through the transfer manager so they are uploaded as concurrent parts
+                self._transfer_config = TransferConfig(
+                    multipart_threshold=16 * 1024**2,
+                    multipart_chunksize=16 * 1024**2,
+                    max_concurrency=10,
+                    use_threads=True,
+                )
+                self._configure_compression()
+
+                # small batches can skip boto3 and be signed and PUT directly, boto3 remains the fallback
+                self._direct_uploader = None
+                if self.logging_config.get("s3_direct_put", False):
+                    credentials = boto3.Session().get_credentials()
+                    if credentials is None:
+                        raise ImproperlyConfigured(
+                            "Direct S3 uploads are enabled for egress logging but no AWS credentials could be resolved"
+                        )
+
+                    self._direct_uploader = DirectS3Uploader(
+                        bucket=self.s3_bucket,
+                        region=self.client.meta.region_name or "us-east-1",
+                        endpoint_url=self.client.meta.endpoint_url,
+                        credentials=credentials,
+                        maxsize=self.logging_config.get("max_pool_connections", 50),
+                    )
+
+                # objects are written to <s3_key_prefix>/YYYY/MM/DD/HH/<token>-<timestamp>-<pid>-<counter>.jsonl
+                # the hourly partitions let lifecycle rules and query engines prune by time, the prefix lets
+                # deployers separate services or environments within a bucket
+                key_prefix = self.logging_config.get("s3_key_prefix", "")
+                self.s3_key_prefix = key_prefix.strip("/")
+                # pids repeat across hosts and containers, a random token drawn once at startup disambiguates them
+                # and leading with it spreads concurrent writers across S3 partitions
+                self._key_token = uuid4().hex[:8]
+                self._key_counter = itertools.count()
+                self._start_s3_flusher()
+                # threads do not survive a fork, a middleware built before the server forks its workers
+                # (gunicorn --preload, uWSGI without lazy-apps) would leave every worker without a flusher
+                os.register_at_fork(after_in_child=self._restart_s3_flusher_after_fork)
+
             case "std_out":
                 self.log_func = self.log_std_out
 
+                # records are written as bytes straight to the stdout buffer in a single call, skipping print's
+                # text encoding and its separate newline write. The buffered writer serializes concurrent writes.
+                # Error messages go to stderr so they never interleave with records written under the text layer.
+                stdout_buffer = getattr(sys.stdout, "buffer", None)
+                if stdout_buffer is not None:
+                    self._stdout_write = stdout_buffer.write
+                    # keep print's behaviour of flushing every line when stdout is interactive
+                    self._stdout_flush = (
+                        stdout_buffer.flush
+                        if getattr(sys.stdout, "line_buffering", False)
+                        else None
+                    )
+                else:
+                    # streams without a byte layer, e.g. mod_wsgi's log object, only accept text
+                    stdout = sys.stdout
+                    self._stdout_write = lambda data: stdout.write(data.decode())
+                    self._stdout_flush = None
+
             case _:
                 raise ImproperlyConfigured(
                     f"Unknown logging type passed to egress logger {self.logging_config['log_type']}"
                 )
 
+    def _configure_compression(self) -> None:
+        self.compression = self.logging_config.get("compression")
+
+        match self.compression:
+            case None:
+                pass
+
+            case "zstd":
+                try:
+                    import zstandard
+                except ImportError:
+                    raise ImproperlyConfigured(
+                        "zstd compression is selected for egress logging but the zstandard package is not installed"
+                    )
+
+                self._zstd = zstandard
+                self._zstd_level = self.logging_config.get("zstd_level", 3)
+                self._zstd_dict = None
+
+                # audit records share most of their content, a trained dictionary compresses them much further
+                if dictionary_path := self.logging_config.get("zstd_dictionary_path"):
+                    with open(dictionary_path, "rb") as dictionary_file:
+                        self._zstd_dict = zstandard.ZstdCompressionDict(
+                            dictionary_file.read()
+                        )
+                    self._zstd_dict.precompute_compress(level=self._zstd_level)
+
+            case _:
+                raise ImproperlyConfigured(
+                    f"Unknown compression passed to egress logger {self.compression}"
+                )
+
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
         start_time = time.time()
         response = self.get_response(request)
         end_time = time.time()
 
         try:
-            if (
-                isinstance(response, AuditableResponse)
-                and response.auditable_content != None
-            ):
-                self._enrich_and_log_audit_data(
-                    request, response.auditable_content, end_time - start_time
+            serializers = self._extract_serializers_from_response(response)
+            auditable = self._is_auditable(response, serializers)
+            if auditable and not self._is_sampled_out(request):
+                self._log_audit_data(
+                    request, response, serializers, end_time - start_time
                 )
-            else:
-                serializers = self._extract_serializers_from_response(response)
-                audit_data = self._extract_egressed_data_ids_from_response(serializers)
 
-                if len(audit_data) != 0:
-                    log_payload = self._enrich_audit_data(
-                        request, audit_data, end_time - start_time
-                    )
-                    self.log_func(log_payload)
+        # log and swallow exception here, we dont want a logging error breaking a user request
+        except Exception as e:
+            print(
+                f"Failed to upload audit logs for request with exception {e}",
+                file=sys.stderr,
+            )
+
+        return response
+
+    async def __acall__(self, request):
+        start_time = time.time()
+        response = await self.get_response(request)
+        end_time = time.time()
+
+        try:
+            serializers = self._extract_serializers_from_response(response)
+
+            # the ORM and request.user are sync only, so audit data is only gathered off the event loop
+            # for responses that can actually carry egressed data
+            auditable = self._is_auditable(response, serializers)
+            if auditable and not self._is_sampled_out(request):
+                await sync_to_async(self._log_audit_data)(
+                    request, response, serializers, end_time - start_time
+                )
 
         # log and swallow exception here, we dont want a logging error breaking a user request
         except Exception as e:
-            print(f"Failed to upload audit logs for request with exception {e}")
+            print(
+                f"Failed to upload audit logs for request with exception {e}",
+                file=sys.stderr,
+            )
 
         return response
 
+    def _is_auditable(self, response: Response, serializers: list[Serializer]) -> bool:
+        # sampling only applies to these, so sampled_out_count never counts errors or responses without egressed data
+        return len(serializers) != 0 or isinstance(response, AuditableResponse)
+
+    def _is_sampled_out(self, request: Request) -> bool:
+        rate = self._samplers.get(request.path, 1.0)
+        if rate >= 1.0 or random.random() < rate:
+            return False
+
+        with self._sampled_out_lock:
+            self._sampled_out[request.path] += 1
+        return True
+
+    def _log_audit_data(
+        self,
+        request: Request,
+        response: Response,
+        serializers: list[Serializer],
+        elapsed_time: float,
+    ) -> None:
+        if (
+            isinstance(response, AuditableResponse)
+            and response.auditable_content is not None
+        ):
+            self._enrich_and_log_audit_data(
+                request, response.auditable_content, elapsed_time
+            )
+        else:
+            audit_data = self._extract_egressed_data_ids_from_response(serializers)
+
+            if len(audit_data) != 0:
+                log_payload = self._enrich_audit_data(request, audit_data, elapsed_time)
+                self._submit_log(log_payload)
+
+    def _submit_log(self, audit_data: AuditPayload) -> None:
+        # the executor's queue is unbounded, each queued record holds a slot until it has been emitted
+        if not self._queued_records.acquire(blocking=False):
+            self._count_dropped_records(1)
+            return
+
+        self._executor.submit(self._log_in_background, audit_data)
+
     def _extract_serializers_from_response(
         self, response: Response
     ) -> list[Serializer]:
         serializers = []
 
         # case where the response is an AuditableResponse
-        if isinstance(response, AuditableResponse) and response.serializers != None:
+        if isinstance(response, AuditableResponse) and response.serializers is not None:
             serializers = response.serializers
 
         # case where response was generated by a built-in ViewSet
@@ -115,15 +418,17 @@ class EgressAuditLogMiddleware:
             if hasattr(response.data, "serializer"):
                 serializers.append(response.data.serializer)
 
-            for member in response.data:
-                if hasattr(response.data[member], "serializer"):
-                    serializers.append(response.data[member].serializer)
+            # list responses carry their serializer on the list itself and have no members to look through
+            if isinstance(response.data, dict):
+                for value in response.data.values():
+                    if (serializer := getattr(value, "serializer", None)) is not None:
+                        serializers.append(serializer)
 
-                elif (
-                    type(response.data[member]) == dict
-                    and "serializer" in response.data[member].keys()
-                ) and response.data[member]["serializer"] is not None:
-                    serializers.append(response.data[member]["serializer"])
+                    elif (
+                        isinstance(value, dict)
+                        and (serializer := value.get("serializer")) is not None
+                    ):
+                        serializers.append(serializer)
 
         # if we cant extract serializers from the request then we assume this is not a route that requires audit logging
         return serializers
@@ -134,34 +439,15 @@ class EgressAuditLogMiddleware:
         audit_data = []
 
         for serializer in serializers:
-            egressed_data = None
-            if isinstance(serializer.instance, QuerySet) or isinstance(
-                serializer.instance, list
-            ):
-                egressed_data = serializer.instance
-
-            elif isinstance(serializer.instance, Page):
-                egressed_data = serializer.instance.object_list
-
-            elif isinstance(serializer.instance, set):
-                egressed_data = list(serializer.instance)
-
-            elif isinstance(serializer.instance, Model):
-                egressed_data = [serializer.instance]
+            if extractor := _get_egressed_data_extractor(type(serializer.instance)):
+                audit_data.extend(extractor(serializer.instance))
 
             else:
                 print(
-                    f"Unknown serializer type {type(serializer.instance)} encountered by egress audit logger"
+                    f"Unknown serializer type {type(serializer.instance)} encountered by egress audit logger",
+                    file=sys.stderr,
                 )
 
-            if egressed_data != None:
-                for data_point in egressed_data:
-                    audit_data.append(
-                        AuditDataElement(
-                            model=type(data_point).__name__, primary_key=data_point.pk
-                        )
-                    )
-
         return audit_data
 
     def _enrich_audit_data(
@@ -169,18 +455,27 @@ class EgressAuditLogMiddleware:
     ) -> AuditPayload:
         username = self._get_user_identifying_information(request=request)
         ip = self._get_caller_ip(request=request)
-        timestamp = timezone.now().isoformat()
+        timestamp = datetime.now(self._tz).isoformat(timespec="milliseconds")
         request_path = request.path
 
-        return AuditPayload(
-            username=username,
-            ip=ip,
-            request_path=request_path,
-            access_time=timestamp,
-            elapsed_time_seconds=elapsed_time,
-            audit_data=audit_data,
-            service_name=settings.EGRESS_LOGGING_CONFIGURATION.get("service_name"),
-        )
+        payload = {
+            "username": username,
+            "ip": ip,
+            "request_path": request_path,
+            "access_time": timestamp,
+            # orjson only serializes exact builtin types
+            "elapsed_time_seconds": float(elapsed_time),
+            "audit_data": audit_data,
+            "service_name": self.service_name,
+        }
+
+        if (sample_rate := self._samplers.get(request_path)) is not None:
+            with self._sampled_out_lock:
+                sampled_out_count = self._sampled_out.pop(request_path, 0)
+            payload["sample_rate"] = sample_rate
+            payload["sampled_out_count"] = sampled_out_count
+
+        return payload
 
     def _get_user_identifying_information(self, request: Request) -> str:
         if request.user.is_authenticated:
@@ -188,21 +483,225 @@ class EgressAuditLogMiddleware:
         else:
             return "Anonymous"
 
-    def _get_caller_ip(self, request: Request) -> str:
-        if x_forwarded_for := request.META.get("HTTP_X_FORWARDED_FOR"):
-            return x_forwarded_for.split(",")[0].strip()
-        elif real_ip := request.META.get("HTTP_X_REAL_IP"):
-            return real_ip
+    def _get_caller_ip(self, request: Request) -> str | None:
+        meta = request.META
+        for header in self._IP_HEADERS:
+            if ip := meta.get(header):
+                # a forwarded header lists the whole proxy chain, the client is the first entry
+                if header == "HTTP_X_FORWARDED_FOR":
+                    return ip.split(",", 1)[0].strip()
+                return ip
+
+        return None
+
+    def _log_in_background(self, audit_data: AuditPayload) -> None:
+        # runs on the executor, nothing is waiting on the future so failures have to be reported here
+        try:
+            self.log_func(audit_data)
+        except Exception as e:
+            print(
+                f"Failed to upload audit logs for request with exception {e}",
+                file=sys.stderr,
+            )
+        finally:
+            self._queued_records.release()
+
+        if self._dropped_records:
+            self._report_dropped_records()
+
+    def _count_dropped_records(self, count: int) -> None:
+        with self._dropped_records_lock:
+            self._dropped_records += count
+
+    def _report_dropped_records(self) -> None:
+        with self._dropped_records_lock:
+            dropped_records, self._dropped_records = self._dropped_records, 0
+
+        if dropped_records:
+            print(
+                f"Dropped {dropped_records} audit records, more than {self.max_buffered_records} were waiting to be emitted",
+                file=sys.stderr,
+            )
+
+    def shutdown(self) -> None:
+        """Block until every queued audit log has been emitted."""
+        self._executor.shutdown(wait=True)
+
+        try:
+            self._log_pending_sampled_out_counts()
+        except Exception as e:
+            print(
+                f"Failed to log sampled out request counts on shutdown with exception {e}",
+                file=sys.stderr,
+            )
+
+        if self.log_func == self.log_s3:
+            self._stop_flushing.set()
+            try:
+                self._flush_s3_buffer()
+            except Exception as e:
+                print(
+                    f"Failed to upload audit logs on shutdown with exception {e}",
+                    file=sys.stderr,
+                )
+
+        self._report_dropped_records()
+
+    def _log_pending_sampled_out_counts(self) -> None:
+        # counts no audited request has carried yet would be lost with the process, so each path gets a record
+        # of its own with no user or audit data
+        with self._sampled_out_lock:
+            sampled_out, self._sampled_out = self._sampled_out, Counter()
+
+        access_time = datetime.now(self._tz).isoformat(timespec="milliseconds")
+        for request_path, sampled_out_count in sampled_out.items():
+            self.log_func(
+                {
+                    "username": None,
+                    "ip": None,
+                    "request_path": request_path,
+                    "access_time": access_time,
+                    "elapsed_time_seconds": None,
+                    "audit_data": [],
+                    "service_name": self.service_name,
+                    "sample_rate": self._samplers[request_path],
+                    "sampled_out_count": sampled_out_count,
+                }
+            )
+
+    def _start_s3_flusher(self) -> None:
+        self._buf: list[bytes] = []
+        self._buf_lock = threading.Lock()
+        self._stop_flushing = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_s3_periodically,
+            name="egress-audit-log-flusher",
+            daemon=True,
+        )
+        self._flusher.start()
+
+    def _restart_s3_flusher_after_fork(self) -> None:
+        if self._stop_flushing.is_set():
+            return
+
+        # records buffered before the fork stay with the parent, and the lock may have been held by one of
+        # its threads, so the child starts over with its own buffer, lock and flusher
+        self._start_s3_flusher()
+
+    def _flush_s3_periodically(self) -> None:
+        while not self._stop_flushing.wait(self.flush_interval_seconds):
+            try:
+                self._flush_s3_buffer()
+            except Exception as e:
+                print(
+                    f"Failed to upload batched audit logs with exception {e}",
+                    file=sys.stderr,
+                )
+
+    def _flush_s3_buffer(self) -> None:
+        with self._buf_lock:
+            batch, self._buf = self._buf, []
+
+        if len(batch) == 0:
+            return
+
+        # a timestamp, the process and a per process counter keep keys unique without generating a uuid per batch
+        timestamp_us = time.time_ns() // 1000
+        name = (
+            f"{self._key_token}-{timestamp_us}-{os.getpid()}-{next(self._key_counter)}"
+        )
+        # partitions are always UTC, local time would shift with DST and fold two hours into one partition
+        key = f"{datetime.now(dt_timezone.utc):%Y/%m/%d/%H}/{name}.jsonl"
+        if self.s3_key_prefix:
+            key = f"{self.s3_key_prefix}/{key}"
+        data_bytes = b"\n".join(batch)
+        extra_args = {}
+
+        if self.compression == "zstd":
+            # compressors are not thread safe and batches can be flushed from several threads at once
+            compressor = self._zstd.ZstdCompressor(
+                level=self._zstd_level, dict_data=self._zstd_dict
+            )
+            data_bytes = compressor.compress(data_bytes)
+            key = f"{key}.zst"
+            extra_args["ContentEncoding"] = "zstd"
+
+        try:
+            self._upload_to_s3(key, data_bytes, extra_args)
+        except Exception:
+            self._requeue_s3_batch(batch)
+            raise
+
+    def _requeue_s3_batch(self, batch: list[bytes]) -> None:
+        # a failed batch goes back in front of the records buffered since, so it is retried by the next flush.
+        # The buffer stays capped, the newest records are dropped past it
+        with self._buf_lock:
+            self._buf[:0] = batch
+            dropped_records = len(self._buf) - self.max_buffered_records
+            if dropped_records > 0:
+                del self._buf[self.max_buffered_records :]
+
+        if dropped_records > 0:
+            self._count_dropped_records(dropped_records)
+
+    def _upload_to_s3(self, key: str, data_bytes: bytes, extra_args: dict) -> None:
+        # multipart setup costs more than it saves on small bodies, so those stay a single PUT
+        if len(data_bytes) < self._transfer_config.multipart_threshold:
+            if self._direct_uploader is not None and self._put_object_directly(
+                key, data_bytes, extra_args
+            ):
+                return
+
+            self.client.put_object(
+                Body=data_bytes, Bucket=self.s3_bucket, Key=key, **extra_args
+            )
         else:
-            return request.META.get("REMOTE_ADDR")
+            self.client.upload_fileobj(
+                io.BytesIO(data_bytes),
+                self.s3_bucket,
+                key,
+                ExtraArgs=extra_args,
+                Config=self._transfer_config,
+            )
+
+    def _put_object_directly(
+        self, key: str, data_bytes: bytes, extra_args: dict
+    ) -> bool:
+        headers = {
+            _S3_EXTRA_ARG_HEADERS[arg]: value for arg, value in extra_args.items()
+        }
+
+        try:
+            return self._direct_uploader.put_object(key, data_bytes, headers)
+        except Exception as e:
+            print(
+                f"Direct S3 upload failed, retrying through boto3 with exception {e}",
+                file=sys.stderr,
+            )
+            return False
 
     # New logging mechanisms can be defined here. Configuration should be handled in _configure_logging()
     # The only allowed parameter is audit_data, which is required, and will be a AuditPayload instance.
     def log_s3(self, audit_data: AuditPayload) -> None:
-        key = f"{uuid4()}.json"
-        data_bytes = json.dumps(audit_data).encode("utf-8")
-        self.client.put_object(Body=data_bytes, Bucket=self.s3_bucket, Key=key)
+        data_bytes = orjson.dumps(audit_data)
+
+        with self._buf_lock:
+            if len(self._buf) >= self.max_buffered_records:
+                buffer_full = True
+            else:
+                buffer_full = False
+                self._buf.append(data_bytes)
+                # only the record completing a batch flushes it. A buffer already past the batch size holds
+                # requeued records from a failed upload, those are left to the periodic flush instead of
+                # retrying on every record while S3 is failing
+                batch_full = len(self._buf) == self.batch_max_records
+
+        if buffer_full:
+            self._count_dropped_records(1)
+        elif batch_full:
+            self._flush_s3_buffer()
 
     def log_std_out(self, audit_data: AuditPayload) -> None:
-        data_str = json.dumps(audit_data)
-        print(data_str)
+        self._stdout_write(orjson.dumps(audit_data) + b"\n")
+        if self._stdout_flush is not None:
+            self._stdout_flush()
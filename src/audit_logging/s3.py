@@ -0,0 +1,138 @@
+import hashlib
+import hmac
+import threading
+import urllib3
+
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+from botocore.credentials import Credentials
+
+
+"""
+Minimal S3 PutObject over a persistent urllib3 connection pool, signed with AWS Signature Version 4.
+It skips boto3's event system, parameter validation and retry handling, which are a large fixed overhead for the small
+objects the audit logger uploads. Any failure is reported to the caller, who is expected to retry through boto3.
+"""
+
+
+def derive_signing_key(
+    secret_key: str, date_stamp: str, region: str, service: str = "s3"
+) -> bytes:
+    k_date = _hmac_sha256(f"AWS4{secret_key}".encode("utf-8"), date_stamp)
+    k_region = _hmac_sha256(k_date, region)
+    k_service = _hmac_sha256(k_region, service)
+    return _hmac_sha256(k_service, "aws4_request")
+
+
+def _hmac_sha256(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+# buckets are addressed by virtual host on these endpoints, anything else is a custom endpoint (MinIO, LocalStack)
+_AWS_ENDPOINT_SUFFIXES = (".amazonaws.com", ".amazonaws.com.cn")
+
+
+class DirectS3Uploader:
+    def __init__(
+        self,
+        bucket: str,
+        region: str,
+        endpoint_url: str,
+        credentials: Credentials,
+        maxsize: int,
+    ) -> None:
+        self.bucket = bucket
+        self.region = region
+        self.credentials = credentials
+
+        # objects go to the same endpoint the boto3 client resolved, addressed the way boto3 addresses them:
+        # virtual hosted on AWS unless the bucket name has dots, which break TLS, and path style otherwise
+        endpoint = urlsplit(endpoint_url)
+        if endpoint.hostname.endswith(_AWS_ENDPOINT_SUFFIXES) and "." not in bucket:
+            self.host = f"{bucket}.{endpoint.netloc}"
+            self.path_prefix = ""
+        else:
+            self.host = endpoint.netloc
+            self.path_prefix = f"/{bucket}"
+        self.base_url = f"{endpoint.scheme}://{self.host}"
+
+        self.pool = urllib3.PoolManager(
+            maxsize=maxsize,
+            block=False,
+            retries=False,
+            timeout=urllib3.Timeout(connect=2, read=10),
+        )
+
+        # the signing key only changes with the date or the credentials, so it is derived once per day
+        self._signing_key_lock = threading.Lock()
+        self._signing_key_scope = None
+        self._signing_key = None
+
+    def put_object(self, key: str, body: bytes, headers: dict[str, str]) -> bool:
+        """Upload body to key, returns whether S3 accepted the object."""
+        credentials = self.credentials.get_frozen_credentials()
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date_stamp = now.strftime("%Y%m%d")
+        scope = f"{date_stamp}/{self.region}/s3/aws4_request"
+
+        signed = {
+            **{name.lower(): value for name, value in headers.items()},
+            "host": self.host,
+            "x-amz-content-sha256": hashlib.sha256(body).hexdigest(),
+            "x-amz-date": amz_date,
+        }
+        if credentials.token:
+            signed["x-amz-security-token"] = credentials.token
+
+        signed_header_names = ";".join(sorted(signed))
+        canonical_headers = "".join(
+            f"{name}:{signed[name].strip()}\n" for name in sorted(signed)
+        )
+        path = f"{self.path_prefix}/" + quote(key, safe="/~")
+        canonical_request = "\n".join(
+            [
+                "PUT",
+                path,
+                "",
+                canonical_headers,
+                signed_header_names,
+                signed["x-amz-content-sha256"],
+            ]
+        )
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            ]
+        )
+        signature = hmac.new(
+            self._get_signing_key(credentials, date_stamp),
+            string_to_sign.encode("utf-8"),
+            hashlib.sha256,
+        ).hexdigest()
+
+        signed["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={credentials.access_key}/{scope}, "
+            f"SignedHeaders={signed_header_names}, Signature={signature}"
+        )
+
+        response = self.pool.request(
+            "PUT", f"{self.base_url}{path}", body=body, headers=signed
+        )
+        return response.status == 200
+
+    def _get_signing_key(self, credentials, date_stamp: str) -> bytes:
+        scope = (credentials.access_key, credentials.secret_key, date_stamp)
+
+        with self._signing_key_lock:
+            if self._signing_key_scope != scope:
+                self._signing_key = derive_signing_key(
+                    credentials.secret_key, date_stamp, self.region
+                )
+                self._signing_key_scope = scope
+
+            return self._signing_key
@@ -1,3 +1,4 @@
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpRequest
 from django.test import TestCase, RequestFactory
 
@@ -6,15 +7,32 @@ from rest_framework.response import Response
 from rest_framework.serializers import ModelSerializer
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from botocore.utils import percent_encode
+from asgiref.sync import iscoroutinefunction
+from datetime import datetime, timezone as dt_timezone
 from moto import mock_s3
+from unittest import skipUnless
 from unittest.mock import patch
+import io
 import json
+import os
+from urllib.parse import urlsplit
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 from audit_logging.middleware import EgressAuditLogMiddleware
+from audit_logging.s3 import DirectS3Uploader, derive_signing_key
 from audit_logging.utils import AuditableResponse
 
-from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.auth.models import AnonymousUser, Group, User
 
 
 class UserSerializer(ModelSerializer):
@@ -120,40 +138,518 @@ class AuditLogTestCase(TestCase):
             req = Request(request=raw_req)
             req.user = self.user
             res = middleware.__call__(req)
+            middleware.shutdown()
             self.assertEqual(res, self.raw_response)
 
-    def _run_middleware_test_with_s3(self, response, user, expected_user_name):
+            # the failed batch is kept for the next flush, cleared so the exit hook does not retry it outside moto
+            self.assertEqual(len(middleware._buf), 1)
+            middleware._buf.clear()
+
+    @mock_s3
+    def test_failed_batch_is_retried_by_the_next_flush(self):
+        upload_to_s3 = EgressAuditLogMiddleware._upload_to_s3
+        uploads = []
+
+        def fail_first_upload(middleware, *args):
+            uploads.append(args)
+            if len(uploads) == 1:
+                raise Exception("S3 is unavailable")
+            upload_to_s3(middleware, *args)
+
+        log_config = {**self.s3_log_config, "batch_max_records": 2, "max_workers": 1}
+        with patch.object(
+            EgressAuditLogMiddleware, "_upload_to_s3", fail_first_upload
+        ), patch("sys.stderr", new=io.StringIO()):
+            objects = self._log_requests_with_s3(log_config, requests=3)
+
+        # the first batch failed and went back in front of the third record, all three are uploaded on shutdown
+        self.assertEqual(len(uploads), 2)
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(len(objects[0][1]["Body"].read().splitlines()), 3)
+
+    @mock_s3
+    def test_records_past_max_buffered_records_are_dropped(self):
+        log_config = {**self.s3_log_config, "max_buffered_records": 2}
+        with patch("sys.stderr", new=io.StringIO()) as stderr:
+            objects = self._log_requests_with_s3(log_config, requests=3)
+
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(len(objects[0][1]["Body"].read().splitlines()), 2)
+        self.assertIn("Dropped 1 audit records", stderr.getvalue())
+
+    @mock_s3
+    def test_log_emission_is_batched_with_s3(self):
+        # a single worker fills and swaps each batch before the next record is appended
+        log_config = {**self.s3_log_config, "batch_max_records": 2, "max_workers": 1}
+        objects = self._log_requests_with_s3(log_config, requests=3)
+        self.assertEqual(len(objects), 2)
+
+        lines = [line for _, obj in objects for line in obj["Body"].read().splitlines()]
+        self.assertEqual(len(lines), 3)
+        [
+            self.assertEqual(json.loads(line)["username"], self.user.username)
+            for line in lines
+        ]
+
+    @mock_s3
+    def test_s3_flusher_is_restarted_in_forked_worker(self):
         with self.settings(EGRESS_LOGGING_CONFIGURATION=self.s3_log_config):
-            req = self.request_factory.get(path="somepath", HTTP_X_REAL_IP="8.8.8.8")
-            req.user = user
+            middleware = EgressAuditLogMiddleware(
+                get_response=lambda request: self.auditable_response
+            )
+            middleware._buf.append(b"{}")
+
+            # mimics a server that builds the application before forking its workers
+            pid = os.fork()
+            if pid == 0:
+                os._exit(
+                    0
+                    if middleware._flusher.is_alive() and len(middleware._buf) == 0
+                    else 1
+                )
+
+            _, status = os.waitpid(pid, 0)
+            middleware._buf.clear()
+            middleware.shutdown()
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
 
-            conn = boto3.resource("s3", region_name="us-east-1")
-            conn.create_bucket(Bucket=self.s3_log_config["s3_bucket"])
+    @mock_s3
+    def test_log_emission_key_is_prefixed_and_partitioned_with_s3(self):
+        objects = self._log_requests_with_s3(
+            {**self.s3_log_config, "s3_key_prefix": "/my-service/"}
+        )
+        self.assertEqual(len(objects), 1)
+        self.assertRegex(
+            objects[0][0],
+            r"^my-service/\d{4}/\d{2}/\d{2}/\d{2}/[0-9a-f]{8}-\d+-\d+-\d+\.jsonl$",
+        )
 
-            middleware = EgressAuditLogMiddleware(get_response=lambda request: response)
+    @mock_s3
+    def test_log_emission_key_is_partitioned_in_utc_with_s3(self):
+        before = datetime.now(dt_timezone.utc)
+        objects = self._log_requests_with_s3(
+            self.s3_log_config, USE_TZ=False, TIME_ZONE="America/New_York"
+        )
+        after = datetime.now(dt_timezone.utc)
 
-            res = middleware.__call__(req)
+        self.assertEqual(len(objects), 1)
+        self.assertIn(
+            objects[0][0][:13], {f"{before:%Y/%m/%d/%H}", f"{after:%Y/%m/%d/%H}"}
+        )
 
-            self.assertEqual(res, response)
+    @skipUnless(zstandard, "zstandard is not installed")
+    @mock_s3
+    def test_log_emission_compressed_with_zstd(self):
+        objects = self._log_requests_with_s3(
+            {**self.s3_log_config, "compression": "zstd"}
+        )
+        self.assertEqual(len(objects), 1)
+        key, obj = objects[0]
+        self.assertTrue(key.endswith(".jsonl.zst"))
+        self.assertIn("zstd", obj["ContentEncoding"])
+        blob = json.loads(zstandard.ZstdDecompressor().decompress(obj["Body"].read()))
+        self.assertEqual(blob["username"], self.user.username)
 
-            bucket = conn.Bucket(self.s3_log_config["s3_bucket"])
+    @mock_s3
+    @patch(
+        "audit_logging.middleware.TransferConfig",
+        # every batch is over the threshold and goes through the transfer manager
+        new=lambda **kwargs: TransferConfig(**{**kwargs, "multipart_threshold": 1}),
+    )
+    def test_large_batch_is_uploaded_with_transfer_manager(self):
+        objects = self._log_requests_with_s3(self.s3_log_config)
+        self.assertEqual(len(objects), 1)
+        _, obj = objects[0]
+        # objects assembled from a multipart upload carry the part count in their ETag
+        self.assertRegex(obj["ETag"], r"-1\"$")
+        self.assertNotIn("ContentEncoding", obj)
+        blob = json.loads(obj["Body"].read())
+        self.assertEqual(blob["username"], self.user.username)
+
+    @skipUnless(zstandard, "zstandard is not installed")
+    @mock_s3
+    @patch(
+        "audit_logging.middleware.TransferConfig",
+        new=lambda **kwargs: TransferConfig(**{**kwargs, "multipart_threshold": 1}),
+    )
+    def test_large_compressed_batch_is_uploaded_with_transfer_manager(self):
+        objects = self._log_requests_with_s3(
+            {**self.s3_log_config, "compression": "zstd"}
+        )
+        self.assertEqual(len(objects), 1)
+        _, obj = objects[0]
+        self.assertRegex(obj["ETag"], r"-1\"$")
+        self.assertIn("zstd", obj["ContentEncoding"])
+        blob = json.loads(zstandard.ZstdDecompressor().decompress(obj["Body"].read()))
+        self.assertEqual(blob["username"], self.user.username)
+
+    def test_sigv4_signing_key_derivation(self):
+        # example from the AWS Signature Version 4 documentation
+        signing_key = derive_signing_key(
+            "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+            "20120215",
+            "us-east-1",
+            service="iam",
+        )
+        self.assertEqual(
+            signing_key.hex(),
+            "f4780e2d9f65fa895f9c67b32ce1baf0b0d8a43505a000a1a9e090d414db404d",
+        )
 
-            objs = list(bucket.objects.all())
-            self.assertEqual(len(objs), 1)
+    @patch("audit_logging.s3.datetime")
+    def test_direct_put_is_signed_like_botocore(self, s3_datetime):
+        s3_datetime.now.return_value = datetime(
+            2026, 10, 15, 12, 30, 45, tzinfo=dt_timezone.utc
+        )
 
-            blob = blob = json.loads(
-                conn.Object(self.s3_log_config["s3_bucket"], objs[0].key)
-                .get()["Body"]
-                .read()
+        credentials = Credentials(
+            "AKIDEXAMPLE",
+            "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+            token="session/token+example=",
+        )
+        uploader = DirectS3Uploader(
+            bucket="unittest-access-audit-logs",
+            region="us-west-2",
+            endpoint_url="https://s3.us-west-2.amazonaws.com",
+            credentials=credentials,
+            maxsize=1,
+        )
+        key = "my-service/2026/10/15/12/a b+c=d~é.jsonl.zst"
+        body = b'{"username": "UserUser"}'
+
+        with patch.object(uploader.pool, "request") as request:
+            request.return_value.status = 200
+            self.assertTrue(
+                uploader.put_object(key, body, {"Content-Encoding": "zstd"})
             )
-            self.assertEqual(blob["username"], expected_user_name)
-            self.assertEqual(blob["request_path"], "/somepath")
-            self.assertEqual(blob["ip"], "8.8.8.8")
 
-            audit_data = blob["audit_data"]
+        method, url = request.call_args.args
+        sent_headers = request.call_args.kwargs["headers"]
+        self.assertEqual(method, "PUT")
+        self.assertEqual(request.call_args.kwargs["body"], body)
+        self.assertEqual(sent_headers["x-amz-date"], "20261015T123045Z")
+
+        # the key is escaped the way botocore escapes it
+        expected_url = (
+            "https://unittest-access-audit-logs.s3.us-west-2.amazonaws.com/"
+            + percent_encode(key, safe="/~")
+        )
+        self.assertEqual(url, expected_url)
+        self.assertEqual(sent_headers["host"], urlsplit(expected_url).netloc)
+
+        # botocore's signing steps are run on the sent timestamp rather than through add_auth,
+        # which reads botocore's own clock
+        auth = S3SigV4Auth(credentials, "s3", "us-west-2")
+        expected = AWSRequest(
+            method="PUT",
+            url=expected_url,
+            data=body,
+            headers={"Content-Encoding": "zstd"},
+        )
+        expected.context["timestamp"] = sent_headers["x-amz-date"]
+        expected.headers["X-Amz-Date"] = sent_headers["x-amz-date"]
+        expected.headers["X-Amz-Security-Token"] = credentials.token
+        expected.headers["X-Amz-Content-SHA256"] = auth.payload(expected)
+
+        signature = auth.signature(
+            auth.string_to_sign(expected, auth.canonical_request(expected)), expected
+        )
+        signed_headers = auth.signed_headers(auth.headers_to_sign(expected))
+        expected.headers["Authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={auth.scope(expected)}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+
+        self.assertEqual(
+            {name: value for name, value in sent_headers.items() if name != "host"},
+            {name.lower(): value for name, value in expected.headers.items()},
+        )
+
+    @mock_s3
+    @patch("audit_logging.s3.DirectS3Uploader.put_object")
+    def test_failed_direct_put_falls_back_to_boto3(self, direct_put_object):
+        direct_put_object.return_value = False
+        objects = self._log_requests_with_s3(
+            {**self.s3_log_config, "s3_direct_put": True}
+        )
+
+        direct_put_object.assert_called_once()
+        self.assertEqual(len(objects), 1)
+
+    @mock_s3
+    @patch.dict(os.environ, {"AWS_ENDPOINT_URL": "http://localhost:9000"})
+    @patch("audit_logging.s3.urllib3.PoolManager.request")
+    def test_direct_put_uses_the_client_endpoint(self, request):
+        request.return_value.status = 200
+        objects = self._log_requests_with_s3(
+            {**self.s3_log_config, "s3_direct_put": True}
+        )
+
+        # nothing was retried through boto3
+        self.assertEqual(objects, [])
+        method, url = request.call_args.args
+        self.assertEqual(method, "PUT")
+        # custom endpoints are addressed by path, as boto3 does
+        self.assertRegex(
+            url, rf"^http://localhost:9000/{self.s3_log_config['s3_bucket']}/.+\.jsonl$"
+        )
+        self.assertEqual(request.call_args.kwargs["headers"]["host"], "localhost:9000")
+
+    @patch("audit_logging.middleware.boto3.Session.get_credentials")
+    def test_direct_put_requires_credentials(self, get_credentials):
+        get_credentials.return_value = None
+        log_config = {**self.s3_log_config, "s3_direct_put": True}
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=log_config):
+            with self.assertRaises(ImproperlyConfigured):
+                EgressAuditLogMiddleware(get_response=lambda request: None)
+
+    def test_log_emission_with_std_out(self):
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with patch("sys.stdout", new=stdout):
+            with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+                req = self.request_factory.get(
+                    path="somepath", HTTP_X_REAL_IP="8.8.8.8"
+                )
+                req.user = self.user
+
+                middleware = EgressAuditLogMiddleware(
+                    get_response=lambda request: self.auditable_response
+                )
+                middleware.__call__(req)
+                middleware.shutdown()
+
+        lines = stdout.buffer.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        blob = json.loads(lines[0])
+        self.assertEqual(blob["username"], self.user.username)
+        self.assertEqual(blob["ip"], "8.8.8.8")
+
+    def test_log_emission_with_text_only_std_out(self):
+        stdout = io.StringIO()
+        with patch("sys.stdout", new=stdout):
+            with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+                req = self.request_factory.get(
+                    path="somepath", HTTP_X_REAL_IP="8.8.8.8"
+                )
+                req.user = self.user
+
+                middleware = EgressAuditLogMiddleware(
+                    get_response=lambda request: self.auditable_response
+                )
+                middleware.__call__(req)
+                middleware.shutdown()
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])["username"], self.user.username)
+
+    @patch("audit_logging.middleware.random.random")
+    @patch("audit_logging.middleware.EgressAuditLogMiddleware.log_std_out")
+    def test_sampled_out_requests_are_counted(self, log_std_out, random):
+        log_config = {**self.std_out_log_config, "sampling": {"/somepath": 0.5}}
+        responses = iter(
+            [
+                self.auditable_response,
+                self.auditable_response,
+                self.auditable_response,
+                # neither sampled nor counted, it carries no egressed data
+                self.raw_response_without_serializer,
+                self.auditable_response,
+                self.auditable_response,
+            ]
+        )
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=log_config):
+            middleware = EgressAuditLogMiddleware(
+                get_response=lambda request: next(responses)
+            )
+
+            random.side_effect = [0.9, 0.9, 0.1, 0.9]
+            for path in ["somepath"] * 5 + ["otherpath"]:
+                req = self.request_factory.get(path=path)
+                req.user = self.user
+                middleware.__call__(req)
+            middleware.shutdown()
+
+            self.assertEqual(random.call_count, 4)
+            self.assertEqual(log_std_out.call_count, 3)
+            # payloads are emitted from the executor, so they are matched by path rather than call order
+            payloads = {
+                (call.args[0]["request_path"], call.args[0]["username"]): call.args[0]
+                for call in log_std_out.call_args_list
+            }
+            sampled_payload = payloads[("/somepath", self.user.username)]
+            self.assertEqual(sampled_payload["sample_rate"], 0.5)
+            self.assertEqual(sampled_payload["sampled_out_count"], 2)
+
+            # the request sampled out after the last audited one is logged on shutdown
+            pending_payload = payloads[("/somepath", None)]
+            self.assertEqual(pending_payload["audit_data"], [])
+            self.assertEqual(pending_payload["sample_rate"], 0.5)
+            self.assertEqual(pending_payload["sampled_out_count"], 1)
+
+            unsampled_payload = payloads[("/otherpath", self.user.username)]
+            self.assertNotIn("sample_rate", unsampled_payload)
+
+    def test_caller_ip_header_precedence(self):
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+            middleware = EgressAuditLogMiddleware(get_response=lambda request: None)
+
+            for headers, expected_ip in [
+                (
+                    {
+                        "HTTP_X_FORWARDED_FOR": "1.1.1.1, 10.0.0.1",
+                        "HTTP_X_REAL_IP": "8.8.8.8",
+                    },
+                    "1.1.1.1",
+                ),
+                ({"HTTP_X_REAL_IP": "8.8.8.8"}, "8.8.8.8"),
+                ({}, "127.0.0.1"),
+            ]:
+                req = self.request_factory.get(path="somepath", **headers)
+                self.assertEqual(middleware._get_caller_ip(req), expected_ip)
+
+            middleware.shutdown()
+
+    def test_serializer_extraction_from_list_response(self):
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+            middleware = EgressAuditLogMiddleware(get_response=lambda request: None)
+            serializer = UserSerializer(User.objects.all(), many=True)
+
+            serializers = middleware._extract_serializers_from_response(
+                Response(data=serializer.data)
+            )
+            self.assertEqual(serializers, [serializer])
+
+            middleware.shutdown()
+
+    def test_egressed_data_extraction_by_instance_type(self):
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+            middleware = EgressAuditLogMiddleware(get_response=lambda request: None)
+            expected = [{"model": User.__name__, "primary_key": self.user.pk}]
+
+            for instance in [
+                self.user,
+                [self.user],
+                {self.user},
+                User.objects.all(),
+            ]:
+                audit_data = middleware._extract_egressed_data_ids_from_response(
+                    [UserSerializer(instance)]
+                )
+                self.assertEqual(audit_data, expected)
+
+            group = Group.objects.create(name="group")
+            audit_data = middleware._extract_egressed_data_ids_from_response(
+                [UserSerializer([self.user, group])]
+            )
+            self.assertEqual(
+                audit_data,
+                [*expected, {"model": Group.__name__, "primary_key": group.pk}],
+            )
+
+            middleware.shutdown()
+
+    def test_queryset_extraction_does_not_build_model_instances(self):
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+            middleware = EgressAuditLogMiddleware(get_response=lambda request: None)
+            queryset = User.objects.all()
+
+            with self.assertNumQueries(1):
+                audit_data = middleware._extract_egressed_data_ids_from_response(
+                    [UserSerializer(queryset)]
+                )
+
+            self.assertIsNone(queryset._result_cache)
+            self.assertEqual(
+                audit_data, [{"model": User.__name__, "primary_key": self.user.pk}]
+            )
+
+            middleware.shutdown()
+
+    def test_evaluated_queryset_extraction_does_not_query(self):
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+            middleware = EgressAuditLogMiddleware(get_response=lambda request: None)
+            serializer = UserSerializer(User.objects.all(), many=True)
+            serializer.data
+
+            with self.assertNumQueries(0):
+                audit_data = middleware._extract_egressed_data_ids_from_response(
+                    [serializer]
+                )
+
+            self.assertEqual(
+                audit_data, [{"model": User.__name__, "primary_key": self.user.pk}]
+            )
+
+            middleware.shutdown()
+
+    @patch("audit_logging.middleware.EgressAuditLogMiddleware.log_std_out")
+    async def test_log_emission_with_async_get_response(self, log_std_out):
+        async def get_response(request):
+            return self.auditable_response
+
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=self.std_out_log_config):
+            req = self.request_factory.get(path="somepath", HTTP_X_REAL_IP="8.8.8.8")
+            req.user = self.user
+
+            middleware = EgressAuditLogMiddleware(get_response=get_response)
+            self.assertTrue(iscoroutinefunction(middleware))
+
+            res = await middleware(req)
+            middleware.shutdown()
+
+            self.assertEqual(res, self.auditable_response)
+            log_std_out.assert_called_once()
+            payload = log_std_out.call_args.args[0]
+            self.assertEqual(payload["username"], self.user.username)
+            self.assertEqual(payload["ip"], "8.8.8.8")
+            self.assertEqual(
+                payload["audit_data"],
+                [{"model": User.__name__, "primary_key": self.user.pk}],
+            )
+
+    def _log_requests_with_s3(
+        self, log_config, response=None, user=None, requests=1, **settings
+    ):
+        """Log requests through a middleware uploading to S3 and return the (key, object) pairs it uploaded."""
+        response = self.auditable_response if response is None else response
+        # the test endpoint is pinned so the bucket lives in moto even when a test overrides AWS_ENDPOINT_URL
+        conn = boto3.resource(
+            "s3", region_name="us-east-1", endpoint_url="https://s3.amazonaws.com"
+        )
+        conn.create_bucket(Bucket=log_config["s3_bucket"])
+
+        with self.settings(EGRESS_LOGGING_CONFIGURATION=log_config, **settings):
+            middleware = EgressAuditLogMiddleware(get_response=lambda request: response)
+
+            for _ in range(requests):
+                req = self.request_factory.get(
+                    path="somepath", HTTP_X_REAL_IP="8.8.8.8"
+                )
+                req.user = self.user if user is None else user
+                self.assertEqual(middleware.__call__(req), response)
+            middleware.shutdown()
+
+        return [
+            (obj.key, obj.get())
+            for obj in conn.Bucket(log_config["s3_bucket"]).objects.all()
+        ]
+
+    def _run_middleware_test_with_s3(self, response, user, expected_user_name):
+        objects = self._log_requests_with_s3(
+            self.s3_log_config, response=response, user=user
+        )
+        self.assertEqual(len(objects), 1)
+
+        blob = json.loads(objects[0][1]["Body"].read())
+        self.assertEqual(blob["username"], expected_user_name)
+        self.assertEqual(blob["request_path"], "/somepath")
+        self.assertEqual(blob["ip"], "8.8.8.8")
+
+        audit_data = blob["audit_data"]
 
-            [self.assertEqual(data["model"], User.__name__) for data in audit_data]
+        [self.assertEqual(data["model"], User.__name__) for data in audit_data]
 
-            origin_data_pks = [data.pk for data in User.objects.all()]
-            self.assertEqual(len(origin_data_pks), len(audit_data))
-            [self.assertIn(data["primary_key"], origin_data_pks) for data in audit_data]
+        origin_data_pks = [data.pk for data in User.objects.all()]
+        self.assertEqual(len(origin_data_pks), len(audit_data))
+        [self.assertIn(data["primary_key"], origin_data_pks) for data in audit_data]